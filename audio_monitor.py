@@ -1,16 +1,35 @@
+"""
+Audio monitor for the Soundscape Analyzer.
+
+Captures microphone audio, extracts decibel level and frequency band power
+for each block, and batches the results into a TimescaleDB hypertable.
+
+Durability: the ingest session runs with synchronous_commit = off, so a
+commit returns before its WAL is flushed to disk. A database crash can
+lose a fraction of a second of the most recent batches (up to three times
+the server's wal_writer_delay, about 600ms by default), but never
+corrupts data. Pass --synchronous-commit to wait for the WAL flush on
+every batch instead.
+"""
 import numpy as np
 import sounddevice as sd
-import psycopg2
-import json
+import psycopg
+import math
 import time
 import logging
 import argparse
 import signal
 import sys
-from scipy.fft import rfft, rfftfreq
+from scipy.fft import rfft, rfftfreq, next_fast_len
 import uuid
-from datetime import datetime
+from datetime import datetime, timezone
 import threading
+import queue
+
+try:
+    from numba import njit
+except ImportError:  # Numba is optional; fall back to the NumPy kernels below
+    njit = None
 
 # Configure logging
 logging.basicConfig(
@@ -23,9 +42,58 @@ logger = logging.getLogger("AudioMonitor")
 # Generate a unique identifier for this sensor
 SENSOR_ID = str(uuid.uuid4())[:8]
 
+# Frequency bands reported for each block; band i spans BAND_EDGES_HZ[i] to BAND_EDGES_HZ[i + 1].
+# Bands that contain no FFT bins (above Nyquist at low sample rates) report 0 power.
+BAND_NAMES = ["sub_bass", "bass", "low_mid", "mid", "upper_mid", "presence", "brilliance"]
+BAND_EDGES_HZ = [20, 60, 250, 500, 2000, 4000, 6000, 20000]
+
+def _rms_numpy(x):
+    """Root mean square of an audio block"""
+    return math.sqrt(float(np.dot(x, x)) / x.size)
+
+def _aggregate_bands_numpy(power, band_idx, band_widths):
+    """Mean power of each band delimited by consecutive band_idx entries"""
+    out = np.zeros(band_widths.size, dtype=np.float32)
+    filled = band_widths > 0
+    if not filled.any():
+        return out
+        
+    # Non-empty bands are contiguous, so reducing from their starts plus the
+    # end of the last one keeps every reduceat index inside the spectrum
+    bounds = np.append(band_idx[:-1][filled], band_idx[1:][filled][-1])
+    sums = np.add.reduceat(power, bounds[bounds < power.size])
+    out[filled] = sums[:np.count_nonzero(filled)] / band_widths[filled]
+    return out
+
+if njit is not None:
+    @njit(cache=True, fastmath=True)
+    def _rms(x):
+        """Root mean square of an audio block"""
+        acc = 0.0
+        for i in range(x.size):
+            acc += x[i] * x[i]
+        return math.sqrt(acc / x.size)
+
+    @njit(cache=True, fastmath=True)
+    def _aggregate_bands(power, band_idx, band_widths):
+        """Mean power of each band delimited by consecutive band_idx entries"""
+        out = np.zeros(band_widths.size, dtype=np.float32)
+        for b in range(band_widths.size):
+            # Empty bands stay at 0, matching _aggregate_bands_numpy
+            if band_widths[b] > 0:
+                acc = 0.0
+                for i in range(band_idx[b], band_idx[b + 1]):
+                    acc += power[i]
+                out[b] = acc / band_widths[b]
+        return out
+else:
+    _rms = _rms_numpy
+    _aggregate_bands = _aggregate_bands_numpy
+
 class AudioMonitor:
     def __init__(self, db_host, db_port, db_name, db_user, db_password, 
-                 location_id, sample_rate=44100, block_duration=0.1):
+                 location_id, sample_rate=44100, block_duration=0.1, use_copy=True,
+                 synchronous_commit=False):
         """
         Initialize the audio monitor
         
@@ -34,6 +102,9 @@ class AudioMonitor:
             location_id: Identifier for this monitoring location
             sample_rate: Audio sample rate in Hz
             block_duration: Duration of each audio block in seconds
+            use_copy: Load batches with COPY; set to False to fall back to
+                multi-row INSERT (e.g. when the table relies on row triggers)
+            synchronous_commit: Wait for the WAL flush on every batch commit
         """
         self.db_params = {
             "host": db_host,
@@ -46,6 +117,19 @@ class AudioMonitor:
         self.sample_rate = sample_rate
         self.block_duration = block_duration
         self.block_size = int(sample_rate * block_duration)
+        self.use_copy = use_copy
+        self.synchronous_commit = synchronous_commit
+        
+        # Frequency analysis state reused for every block; blocks are zero-padded
+        # to a length pocketfft handles efficiently (4410 samples is not)
+        self.fft_n = next_fast_len(self.block_size, real=True)
+        self._window = np.hanning(self.block_size).astype(np.float32)
+        self._padded = np.zeros(self.fft_n, dtype=np.float32)
+        self._freqs = rfftfreq(self.fft_n, 1/self.sample_rate)
+        
+        # FFT bin boundaries of each band; bands above Nyquist have zero width
+        self._band_idx = np.searchsorted(self._freqs, BAND_EDGES_HZ)
+        self._band_widths = np.diff(self._band_idx).astype(np.float32)
         
         self.running = False
         self.stream = None
@@ -53,38 +137,58 @@ class AudioMonitor:
         self.cursor = None
         
         # Batch processing
-        self.batch_buffer = []
-        self.batch_lock = threading.Lock()
-        self.batch_size = 10  # Start with smaller batches for direct insertion
-        self.flush_interval = 1.0  # Flush every second
-        self.flush_timer = None
+        self.batch_queue = queue.Queue(maxsize=10000)
+        self.min_batch_size = 100
+        self.max_batch_size = 5000
+        self.batch_size = self.min_batch_size  # Adapted to queue depth after each flush
+        self.flush_interval = 5.0  # Upper bound on how long records wait in the buffer
+        
+        # Writer thread owns the database connection once monitoring starts
+        self._writer_thread = None
+        self._writer_failed = False
+        self._wakeup = threading.Event()
         
     def start(self):
-        """Start audio monitoring and database insertion"""
+        """Start audio monitoring and database insertion, returning False on failure"""
         try:
             # Connect to database
-            self.conn = psycopg2.connect(**self.db_params)
+            self.conn = psycopg.connect(**self.db_params)
             self.conn.autocommit = False
             self.cursor = self.conn.cursor()
             
+            # Let batch commits return without waiting for the WAL flush
+            if not self.synchronous_commit:
+                self.cursor.execute("SET synchronous_commit = off")
+                self.conn.commit()
+            
+            # Prepare statements server-side on first use so the INSERT
+            # fallback skips parsing and planning on every batch
+            self.conn.prepare_threshold = 0
+            
             # Register sensor if needed
             self.register_sensor()
             
-            logger.info(f"Connected to TimescaleDB at {self.db_params['host']}:{self.db_params['port']}")
-            logger.info(f"Starting audio monitoring at location {self.location_id} with sensor {SENSOR_ID}")
+            logger.info("Connected to TimescaleDB at %s:%s", self.db_params['host'], self.db_params['port'])
+            logger.info("Starting audio monitoring at location %s with sensor %s", self.location_id, SENSOR_ID)
             
             # Set up signal handling for graceful shutdown
             signal.signal(signal.SIGINT, self.handle_signal)
             signal.signal(signal.SIGTERM, self.handle_signal)
             
-            # Start flush timer
-            self.schedule_flush()
+            # Compile (or load cached) numeric kernels before the first audio callback
+            self.warm_up()
             
-            # Start audio stream
             self.running = True
+            
+            # Start the writer thread that flushes batches to the database
+            self._writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+            self._writer_thread.start()
+            
+            # Start audio stream
             self.stream = sd.InputStream(
                 callback=self.audio_callback,
                 channels=1,
+                dtype='float32',
                 samplerate=self.sample_rate,
                 blocksize=self.block_size
             )
@@ -95,27 +199,31 @@ class AudioMonitor:
             while self.running:
                 time.sleep(0.5)
                 
+            if self._writer_failed:
+                raise RuntimeError("database writer stopped")
+                
         except Exception as e:
-            logger.error(f"Error in audio monitoring: {e}")
+            logger.error("Error in audio monitoring: %s", e)
             self.stop()
+            return False
+            
+        return True
             
     def stop(self):
         """Stop monitoring and clean up resources"""
         self.running = False
         
-        # Cancel timer if running
-        if self.flush_timer is not None:
-            self.flush_timer.cancel()
-            self.flush_timer = None
-        
-        # Flush any remaining records
-        self.flush_batch()
-        
         if self.stream:
             self.stream.stop()
             self.stream.close()
             self.stream = None
             
+        # Wake the writer thread so it flushes any remaining records and exits
+        if self._writer_thread is not None:
+            self._wakeup.set()
+            self._writer_thread.join()
+            self._writer_thread = None
+            
         if self.cursor:
             self.cursor.close()
             self.cursor = None
@@ -126,174 +234,250 @@ class AudioMonitor:
             
         logger.info("Audio monitoring stopped")
         
+    def warm_up(self):
+        """Run the analysis once on a silent block shaped like the stream's input"""
+        silence = np.zeros((self.block_size, 1), dtype=np.float32)[:, 0]
+        self.calculate_decibel(silence)
+        self.analyze_frequency(silence)
+        
     def handle_signal(self, sig, frame):
         """Handle termination signals"""
-        logger.info(f"Received signal {sig}, shutting down...")
+        logger.info("Received signal %s, shutting down...", sig)
         self.stop()
         sys.exit(0)
     
-    def schedule_flush(self):
-        """Schedule the next batch flush"""
-        if not self.running:
-            return
-            
-        self.flush_timer = threading.Timer(self.flush_interval, self.timed_flush)
-        self.flush_timer.daemon = True
-        self.flush_timer.start()
-        
-    def timed_flush(self):
-        """Flush the batch on timer"""
-        self.flush_batch()
-        self.schedule_flush()
+    def _writer_loop(self):
+        """Flush batches when one fills up or the flush interval elapses"""
+        try:
+            while self.running:
+                # Only sleep while short of a full batch; a backlog is drained back to back
+                if self.batch_queue.qsize() < self.batch_size:
+                    self._wakeup.wait(self.flush_interval)
+                    self._wakeup.clear()
+                self._flush(self._drain(self.batch_size))
+                self.adjust_batch_size()
+                
+            # Flush any remaining records
+            drained = self._drain(self.max_batch_size)
+            while drained:
+                self._flush(drained)
+                drained = self._drain(self.max_batch_size)
+                
+        except Exception as e:
+            # Without a working connection nothing more can be stored; stop the
+            # monitor so the process exits with an error and can be restarted
+            logger.error("Database writer failed, stopping monitor: %s", e)
+            self._writer_failed = True
+            self.running = False
         
+    def adjust_batch_size(self):
+        """Grow the batch size while the queue backs up and shrink it once it drains"""
+        backlog = self.batch_queue.qsize()
+        if backlog > 2 * self.batch_size:
+            self.batch_size = min(self.batch_size * 2, self.max_batch_size)
+        elif backlog < self.batch_size // 4:
+            self.batch_size = max(self.batch_size // 2, self.min_batch_size)
+            
     def audio_callback(self, indata, frames, time_info, status):
         """Process audio data and add to batch"""
         if status:
-            logger.warning(f"Audio status: {status}")
+            logger.warning("Audio status: %s", status)
             
         try:
-            # Extract audio data from first channel
-            audio_data = indata[:, 0].copy()
+            # View of the first channel; sounddevice reuses indata after the
+            # callback returns, so it must be fully consumed before then
+            audio_data = indata[:, 0]
             
             # Calculate metrics
             db_level = self.calculate_decibel(audio_data)
             frequency_bands = self.analyze_frequency(audio_data)
             
-            # Create record
-            timestamp = datetime.now().isoformat()
+            # Create record; the epoch timestamp is converted at flush time
             record = {
-                "timestamp": timestamp,
+                "timestamp": time.time_ns(),
                 "sensor_id": SENSOR_ID,
                 "location_id": self.location_id,
                 "decibel_level": float(db_level),
                 "frequency_bands": frequency_bands
             }
             
-            # Add to batch
-            with self.batch_lock:
-                self.batch_buffer.append(record)
+            # Queue for the writer thread, dropping the record if it has fallen behind
+            try:
+                self.batch_queue.put_nowait(record)
+            except queue.Full:
+                logger.warning("Batch queue full, dropping audio record")
+                return
                 
-                # If batch is full, flush it
-                if len(self.batch_buffer) >= self.batch_size:
-                    # Flush in a separate thread to avoid blocking audio processing
-                    threading.Thread(target=self.flush_batch).start()
+            # If batch is full, wake the writer thread to flush it
+            if self.batch_queue.qsize() >= self.batch_size:
+                self._wakeup.set()
             
         except Exception as e:
-            logger.error(f"Error processing audio: {e}")
+            logger.error("Error processing audio: %s", e)
     
-    def calculate_decibel(self, audio_chunk, reference=1.0):
-        """Calculate decibel level from audio chunk"""
-        # Convert to float and normalize
-        audio_data = audio_chunk.astype(np.float32) / 32768.0
-        
-        # Root mean square (RMS) value
-        rms = np.sqrt(np.mean(np.square(audio_data)))
+    def calculate_decibel(self, x, reference=1.0):
+        """Calculate decibel level from a float32 audio chunk in [-1, 1]"""
+        # Root mean square (RMS) value in a single pass over the block
+        rms = _rms(x)
         
         # Convert to decibel scale (dB)
         if rms > 0:
-            db = 20 * np.log10(rms / reference)
+            db = 20 * math.log10(rms / reference)
         else:
             db = -96  # Approximately silence
             
         return db
     
     def analyze_frequency(self, audio_data):
-        """Analyze frequency components of audio data"""
-        # Apply window function to reduce spectral leakage
-        windowed_data = audio_data * np.hanning(len(audio_data))
-        
-        # Perform FFT
-        fft_data = np.abs(rfft(windowed_data))
+        """Analyze frequency components of audio data as mean power per band, ordered as BAND_NAMES"""
+        # Apply window function to reduce spectral leakage and perform FFT
+        # on the zero-padded buffer, leaving the padding intact for reuse
+        np.multiply(audio_data, self._window, out=self._padded[:self.block_size])
+        spec = rfft(self._padded, overwrite_x=False, workers=1)
         
-        # Get frequency bins
-        freqs = rfftfreq(len(audio_data), 1/self.sample_rate)
+        # Power spectrum (squared magnitude) avoids a sqrt per bin; float32 input
+        # gives a complex64 spectrum, so power stays float32
+        power = spec.real * spec.real + spec.imag * spec.imag
         
-        # Group frequencies into bands
-        bands = {}
-        bands["sub_bass"] = float(np.mean(fft_data[(freqs >= 20) & (freqs < 60)]))
-        bands["bass"] = float(np.mean(fft_data[(freqs >= 60) & (freqs < 250)]))
-        bands["low_mid"] = float(np.mean(fft_data[(freqs >= 250) & (freqs < 500)]))
-        bands["mid"] = float(np.mean(fft_data[(freqs >= 500) & (freqs < 2000)]))
-        bands["upper_mid"] = float(np.mean(fft_data[(freqs >= 2000) & (freqs < 4000)]))
-        bands["presence"] = float(np.mean(fft_data[(freqs >= 4000) & (freqs < 6000)]))
-        bands["brilliance"] = float(np.mean(fft_data[(freqs >= 6000) & (freqs < 20000)]))
+        # Group frequencies into bands with one pass over the spectrum
+        means = _aggregate_bands(power, self._band_idx, self._band_widths)
         
-        return bands
+        return means
     
     def register_sensor(self):
         """Register this sensor in the database if it doesn't exist"""
         try:
-            # Check if sensor exists
+            # Create sensor record unless it already exists
             self.cursor.execute(
-                "SELECT 1 FROM sound_sensors WHERE sensor_id = %s",
-                (SENSOR_ID,)
+                """
+                INSERT INTO sound_sensors (sensor_id, location_id, description)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (sensor_id) DO NOTHING
+                """,
+                (SENSOR_ID, self.location_id, f"Sensor at {self.location_id}")
             )
+            self.conn.commit()
             
-            if not self.cursor.fetchone():
-                # Create sensor record
-                self.cursor.execute(
-                    """
-                    INSERT INTO sound_sensors (sensor_id, location_id, description)
-                    VALUES (%s, %s, %s)
-                    """,
-                    (SENSOR_ID, self.location_id, f"Sensor at {self.location_id}")
-                )
-                self.conn.commit()
-                logger.info(f"Registered new sensor {SENSOR_ID} for location {self.location_id}")
+            if self.cursor.rowcount == 1:
+                logger.info("Registered new sensor %s for location %s", SENSOR_ID, self.location_id)
             else:
-                logger.info(f"Sensor {SENSOR_ID} already registered")
+                logger.info("Sensor %s already registered", SENSOR_ID)
                 
         except Exception as e:
-            logger.error(f"Error registering sensor: {e}")
+            logger.error("Error registering sensor: %s", e)
             self.conn.rollback()
             raise
             
-    def flush_batch(self):
-        """Flush the current batch to TimescaleDB"""
-        with self.batch_lock:
-            # Skip if batch is empty
-            if not self.batch_buffer:
-                return
-                
-            batch_to_flush = self.batch_buffer
-            self.batch_buffer = []
+    def _drain(self, max_records):
+        """Take up to max_records records from the queue without blocking"""
+        drained = []
+        while len(drained) < max_records:
+            try:
+                drained.append(self.batch_queue.get_nowait())
+            except queue.Empty:
+                break
+        return drained
+        
+    def _flush(self, batch_to_flush):
+        """Flush a batch of records to TimescaleDB"""
+        # Skip if batch is empty
+        if not batch_to_flush:
+            return
             
         try:
-            # Build values clause and parameters
-            values_parts = []
-            params = []
-            
-            for record in batch_to_flush:
-                values_parts.append("(%s, %s, %s, %s, %s::jsonb)")
-                params.extend([
-                    record["timestamp"],
-                    record["sensor_id"],
-                    record["location_id"],
-                    record["decibel_level"],
-                    json.dumps(record["frequency_bands"])
-                ])
-                
-            # Construct and execute query
-            sql = f"""
-            INSERT INTO sound_metrics (time, sensor_id, location_id, decibel_level, frequency_bands)
-            VALUES {", ".join(values_parts)}
-            """
-            
-            self.cursor.execute(sql, params)
+            if self.use_copy:
+                self.copy_records(batch_to_flush)
+            else:
+                self.insert_records(batch_to_flush)
             self.conn.commit()
             
-            logger.info(f"Inserted batch of {len(batch_to_flush)} records")
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Inserted batch of %d records", len(batch_to_flush))
             
         except Exception as e:
-            logger.error(f"Error flushing batch: {e}")
+            logger.error("Error flushing batch: %s", e)
+            # Raises if the connection itself is gone, which stops the writer loop
             self.conn.rollback()
 
+    def copy_records(self, records):
+        """Stream records into sound_metrics through a binary COPY"""
+        with self.cursor.copy(
+            "COPY sound_metrics (time, sensor_id, location_id, decibel_level, frequency_bands) "
+            "FROM STDIN WITH (FORMAT BINARY)"
+        ) as copy:
+            copy.set_types(["timestamptz", "text", "text", "float4", "float4[]"])
+            for record in records:
+                copy.write_row((
+                    datetime.fromtimestamp(record["timestamp"] / 1e9, tz=timezone.utc),
+                    record["sensor_id"],
+                    record["location_id"],
+                    record["decibel_level"],
+                    record["frequency_bands"].tolist()
+                ))
+        
+    def insert_records(self, records):
+        """Insert records into sound_metrics, pipelining the prepared INSERT"""
+        with self.conn.pipeline():
+            self.cursor.executemany(
+                """
+                INSERT INTO sound_metrics (time, sensor_id, location_id, decibel_level, frequency_bands)
+                VALUES (%s, %s, %s, %s, %s)
+                """,
+                [
+                    (
+                        datetime.fromtimestamp(record["timestamp"] / 1e9, tz=timezone.utc),
+                        record["sensor_id"],
+                        record["location_id"],
+                        record["decibel_level"],
+                        record["frequency_bands"].tolist()
+                    )
+                    for record in records
+                ]
+            )
+
+def setup_continuous_aggregate(cursor):
+    """Create the one-second continuous aggregate, warning instead of failing if unsupported"""
+    try:
+        # Roll raw blocks up to one row per second server-side, so consumers
+        # that only need per-second means never have to aggregate themselves
+        band_averages = ",\n            ".join(
+            f"AVG(frequency_bands[{i}]) AS avg_{name}" for i, name in enumerate(BAND_NAMES, start=1)
+        )
+        cursor.execute(f"""
+        CREATE MATERIALIZED VIEW IF NOT EXISTS sound_metrics_1s
+        WITH (timescaledb.continuous) AS
+        SELECT
+            time_bucket('1 second', time) AS bucket,
+            sensor_id,
+            location_id,
+            AVG(decibel_level) AS avg_decibel,
+            MAX(decibel_level) AS max_decibel,
+            MIN(decibel_level) AS min_decibel,
+            {band_averages}
+        FROM sound_metrics
+        GROUP BY bucket, sensor_id, location_id
+        WITH NO DATA
+        """)
+        
+        # Refresh behind the writer's flush interval so late batches are included
+        cursor.execute("""
+        SELECT add_continuous_aggregate_policy('sound_metrics_1s',
+            start_offset => INTERVAL '1 hour',
+            end_offset => INTERVAL '1 minute',
+            schedule_interval => INTERVAL '1 minute',
+            if_not_exists => TRUE)
+        """)
+        
+    except Exception as e:
+        # Apache-2-only TimescaleDB builds lack continuous aggregates and their policies
+        logger.warning("Skipping sound_metrics_1s continuous aggregate: %s", e)
+
 def setup_database(db_params):
     """Set up the database schema if it doesn't exist"""
     conn = None
     try:
         # Connect to database
-        conn = psycopg2.connect(**db_params)
+        conn = psycopg.connect(**db_params)
         conn.autocommit = True
         cursor = conn.cursor()
         
@@ -321,12 +505,27 @@ def setup_database(db_params):
             time TIMESTAMPTZ NOT NULL,
             sensor_id TEXT NOT NULL,
             location_id TEXT NOT NULL,
-            decibel_level FLOAT NOT NULL,
-            frequency_bands JSONB NOT NULL,
+            decibel_level REAL NOT NULL,
+            frequency_bands REAL[] NOT NULL,
             FOREIGN KEY (sensor_id) REFERENCES sound_sensors(sensor_id)
         )
         """)
         
+        # Expose the band array under its band names for downstream queries
+        band_columns = ",\n            ".join(
+            f"frequency_bands[{i}] AS {name}" for i, name in enumerate(BAND_NAMES, start=1)
+        )
+        cursor.execute(f"""
+        CREATE OR REPLACE VIEW sound_metrics_bands AS
+        SELECT
+            time,
+            sensor_id,
+            location_id,
+            decibel_level,
+            {band_columns}
+        FROM sound_metrics
+        """)
+        
         # Check if table is already a hypertable
         cursor.execute("""
         SELECT * FROM timescaledb_information.hypertables 
@@ -341,11 +540,14 @@ def setup_database(db_params):
                                     if_not_exists => TRUE)
             """)
             
+        # Optional one-second rollup; ingest works without it
+        setup_continuous_aggregate(cursor)
+        
         logger.info("Database schema setup complete")
         return True
         
     except Exception as e:
-        logger.error(f"Error setting up database: {e}")
+        logger.error("Error setting up database: %s", e)
         return False
         
     finally:
@@ -363,6 +565,9 @@ def main():
     parser.add_argument("--location-id", required=True, help="Location identifier")
     parser.add_argument("--sample-rate", type=int, default=44100, help="Audio sample rate")
     parser.add_argument("--block-duration", type=float, default=0.1, help="Audio block duration in seconds")
+    parser.add_argument("--no-copy", action="store_true", help="Insert batches with INSERT instead of COPY")
+    parser.add_argument("--synchronous-commit", action="store_true",
+                        help="Wait for the WAL flush on every batch commit")
     
     args = parser.parse_args()
     
@@ -389,10 +594,13 @@ def main():
         args.db_password,
         args.location_id,
         args.sample_rate,
-        args.block_duration
+        args.block_duration,
+        use_copy=not args.no_copy,
+        synchronous_commit=args.synchronous_commit
     )
     
-    monitor.start()
+    if not monitor.start():
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()